@@ -5,66 +5,149 @@ Created on Fri May 31 16:56:13 2013
 @author: proto
 """
 
-from SimpleXMLRPCServer import SimpleXMLRPCServer
+try:
+    from gevent import monkey
+except ImportError:
+    raise ImportError('server.py needs gevent, install it with "pip install gevent" (see INSTALL)')
+import multiprocessing
+
+# Translations are CPU bound and would stall every connection if they ran on
+# the gevent hub, so they go to worker processes. The pool is forked before
+# gevent patches anything, so its workers are plain processes.
+translationPool = multiprocessing.Pool()
+# Seconds a call waits for its translation. The pool replaces a worker that
+# dies (a libsbml crash, the OOM killer) but never reports the lost call, so
+# without a bound the client would hang and the wait would hold one of the
+# hub's threadpool threads for good. Generous, as big models take minutes.
+translationTimeout = 600
+
+# Must run before anything else imports socket/time so that their blocking
+# calls yield to other greenlets. threading is left unpatched: the pool
+# hands its results over on native threads. So are os, signal and
+# subprocess: the pool forks replacement workers from a native thread,
+# and gevent's fork only works on the hub.
+monkey.patch_all(thread=False, os=False, signal=False, subprocess=False)
+
+from SimpleXMLRPCServer import SimpleXMLRPCDispatcher
 from SimpleXMLRPCServer import SimpleXMLRPCRequestHandler
-import threading
-import SocketServer
-from os import listdir
-from os.path import isfile, join
+import gevent
+from gevent.pywsgi import WSGIServer
+import xmlrpclib
+import os
 
 import libsbml2bngl
+from utils.util import listFiles
 # Restrict to a particular path.
-class RequestHandler(SimpleXMLRPCRequestHandler):
-    rpc_paths = ('/RPC2',)
-    
-class RPCThreading(SocketServer.ThreadingMixIn, SimpleXMLRPCServer):
-    pass
+rpc_paths = ('/RPC2',)
+# Responses larger than about one TCP segment are gzipped for clients that
+# accept it, same as SimpleXMLRPCRequestHandler.encode_threshold
+encode_threshold = 1400
 
-# Create server
-server = RPCThreading(("10.253.98.102", 9000),requestHandler=RequestHandler)
-#server = SimpleXMLRPCServer(("127.0.0.1", 9000), requestHandler=RequestHandler)
-server.register_introspection_functions()
+# Create the dispatcher. Connections are handled by greenlets on a single
+# gevent hub, not by one thread per request; translations run in
+# translationPool. The system.* introspection methods are not registered.
+dispatcher = SimpleXMLRPCDispatcher(allow_none=False, encoding=None)
 
+def acceptEncodings(environ):
+    """
+    Parses the Accept-Encoding header into {content-coding: q}, the same
+    way SimpleXMLRPCRequestHandler.accept_encodings does, except that
+    content-codings are matched case-insensitively
+    """
+    r = {}
+    for e in environ.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        match = SimpleXMLRPCRequestHandler.aepattern.match(e)
+        if match:
+            v = match.group(3)
+            try:
+                r[match.group(1).lower()] = float(v) if v else 1.0
+            except ValueError:
+                pass
+    return r
 
+def application(environ, start_response):
+    """
+    WSGI entry point: feeds the POSTed XML-RPC body to the dispatcher,
+    handling gzip Content-Encoding in both directions
+    """
+    if environ['PATH_INFO'] not in rpc_paths:
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return ['No such page']
+    if environ['REQUEST_METHOD'] != 'POST':
+        start_response('501 Unsupported method', [('Content-Type', 'text/plain')])
+        return ['']
+    length = int(environ.get('CONTENT_LENGTH') or 0)
+    data = environ['wsgi.input'].read(length)
+    encoding = environ.get('HTTP_CONTENT_ENCODING', 'identity').lower()
+    if encoding == 'gzip':
+        try:
+            data = xmlrpclib.gzip_decode(data)
+        except ValueError:
+            start_response('400 Bad Request', [('Content-Type', 'text/plain')])
+            return ['error decoding gzip content']
+    elif encoding != 'identity':
+        start_response('501 Not Implemented', [('Content-Type', 'text/plain')])
+        return ['encoding %r not supported' % encoding]
+    response = dispatcher._marshaled_dispatch(data)
+    headers = [('Content-Type', 'text/xml')]
+    if len(response) > encode_threshold and \
+            acceptEncodings(environ).get('gzip', 0) > 0:
+        response = xmlrpclib.gzip_encode(response)
+        headers.append(('Content-Encoding', 'gzip'))
+    headers.append(('Content-Length', str(len(response))))
+    start_response('200 OK', headers)
+    return [response]
 
-iid = 1
-iid_lock = threading.Lock()
 
-def next_id():
-    global iid
-    with iid_lock:
-        result = iid
-        iid += 1
-    return result   
 
-processDict = {}
+conventionCache = {}
+
+def listConventions(directory):
+    """
+    Returns the reaction and species definition files in directory. The
+    listing is reused until the directory's mtime changes.
+    """
+    key = (directory, os.stat(directory).st_mtime)
+    if key not in conventionCache:
+        conventionCache.clear()
+        onlyfiles = listFiles(directory)
+        reactionFiles = [x for x in onlyfiles if 'reaction' in x]
+        speciesFiles = [x for x in onlyfiles if 'species' in x ]
+        conventionCache[key] = (reactionFiles,speciesFiles)
+    return conventionCache[key]
+
+def runInPool(func, *args):
+    """
+    Runs func(*args) in translationPool. The blocking wait happens on a
+    thread of the gevent threadpool, so only the calling greenlet waits
+    for the result while the hub keeps serving other connections. Gives up
+    after translationTimeout seconds, which the client gets as a Fault.
+    """
+    result = translationPool.apply_async(func, args)
+    try:
+        return gevent.get_hub().threadpool.apply(result.get, (translationTimeout,))
+    except multiprocessing.TimeoutError:
+        raise multiprocessing.TimeoutError('translation did not finish within %d seconds' % translationTimeout)
+
+reactionDefinitions = 'config/reactionDefinitions.json'
 
 class AtomizerServer:
     
     def __init__(self):
         pass
-    def atomize(self, bxmlFile,atomize=False,reaction='config/reactionDefinitions.json',species=None):
-        counter = next_id()
-        xmlFile = bxmlFile.data
-        species = 'config/' + species
-        reaction = 'config/reactionDefinitions.json'
-        
-        
-        result = libsbml2bngl.readFromString(xmlFile,
-                                             reaction,True,None,atomize)
-        
-        
-        return result
+    def atomize(self, bxmlFile,atomize=False,reaction=reactionDefinitions,species=None):
+        # reaction and species are accepted for client compatibility, but
+        # translation always runs with the default reaction definitions
+        return runInPool(libsbml2bngl.readFromString, bxmlFile.data,
+                         reactionDefinitions,True,None,atomize)
     def getSpeciesConventions(self):
-        onlyfiles = [ f for f in listdir('./reactionDefinitions') if isfile(join('./reactionDefinitions',f)) ]
-        reactionFiles = [x for x in onlyfiles if 'reaction' in x]
-        speciesFiles = [x for x in onlyfiles if 'species' in x ]
-        
-        return reactionFiles,speciesFiles
+        return listConventions('./reactionDefinitions')
 
 
         
-server.register_instance(AtomizerServer())
+dispatcher.register_instance(AtomizerServer())
 
+server = WSGIServer(("10.253.98.102", 9000), application)
+#server = WSGIServer(("127.0.0.1", 9000), application)
 # Run the server's main loop
 server.serve_forever()
@@ -4,180 +4,296 @@ Created on Thu Feb  7 18:20:33 2013
 
 @author: proto
 """
-from os import listdir
-from os.path import isfile, join
+from os import devnull
+from os.path import join
 import os
-import subprocess
-import time
-import datetime
+import re
 import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import multiprocessing
+sys.path.insert(0, '..')
+from utils.util import listFiles
+
 
+def waitWithTimeout(process, timeout):
+    """
+    Blocks until process exits, killing it once timeout seconds have
+    passed. Returns False if the process had to be killed. process must
+    have been started with preexec_fn=os.setsid: the kill goes to its
+    whole process group so that helpers it spawned (run_network) die with
+    it, without touching anybody else's bngdev.
 
+    Nothing polls here: the caller sleeps in waitpid until the child exits
+    and the timer thread sleeps until the deadline, so a pool worker
+    supervising a bngdev run only wakes up when one of the two fires. The
+    process driving the pool in main() likewise sleeps in a pipe read
+    until a worker hands back a result.
+    """
+    expired = []
+    def kill():
+        #only the calling thread reaps the child: Popen has no locking in
+        #python 2, and a second waitpid here could steal its exit status
+        expired.append(True)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            #the process group had already exited
+            pass
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        process.wait()
+    except BaseException:
+        #process runs in its own session, so a Ctrl-C on the terminal never
+        #reaches it: take its group down before letting the error through
+        error = sys.exc_info()
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        process.wait()
+        raise error[0], error[1], error[2]
+    finally:
+        timer.cancel()
+    #a child that exited on its own right at the deadline still counts as
+    #finished
+    return not expired or process.returncode >= 0
+
+#bngdev stderr messages that evaluate and main tell apart
+abortMessage = 'ABORT: Reaction rule list could not be read because of errors'
+stderrPattern = re.compile('cvode|' + re.escape(abortMessage))
 
 def evaluate(fileName):
     timeout = 30
     with open('temp.tmp', "w") as outfile:
         d = open('dummy.tmp','w')
-        start = datetime.datetime.now()
-        result = subprocess.Popen(['bngdev', './' + fileName],stderr=outfile,stdout=d)
+        result = subprocess.Popen(['bngdev', fileName],stderr=outfile,stdout=d,preexec_fn=os.setsid)
         #result = subprocess.Popen(['bngdev', './' + fileName],stderr=outfile,stdout=d)
-        while result.poll() is None:
-            time.sleep(0.1)
-            now = datetime.datetime.now()
-            if (now - start).seconds > timeout:
-                os.kill(result.pid, signal.SIGKILL)
-                os.waitpid(-1, os.WNOHANG)
-                subprocess.call(['killall','run_network'])
-                subprocess.call(['killall','bngdev'])
-                return 5
-            d.close()
+        finished = waitWithTimeout(result, timeout)
+        d.close()
+        if not finished:
+            return 5
         
-        if  result.poll() > 0:
-            with open('temp.tmp','r') as outfile:
-                lines = outfile.readlines()
-            if 'cvode' in ','.join(lines):
+        if  result.returncode > 0:
+            with open('temp.tmp','rb') as outfile:
+                errors = set(stderrPattern.findall(outfile.read()))
+            if 'cvode' in errors:
                 return 2
-            elif 'ABORT: Reaction rule list could not be read because of errors' in ','.join(lines):
+            elif abortMessage in errors:
                 return 3
             else:
                 return 4
         else:
-            return result.poll()
+            return result.returncode
             
 def validate(fileName):
     timeout = 30
     with open('temp.tmp', "w") as outfile:
         d = open('dummy.tmp','w')
-        start = datetime.datetime.now()
-        result = subprocess.Popen(['bngdev','--xml', './' + fileName],stderr=outfile,stdout=d)
+        result = subprocess.Popen(['bngdev','--xml', fileName],stderr=outfile,stdout=d,preexec_fn=os.setsid)
 
-        while result.poll() is None:
-            time.sleep(0.1)
-            now = datetime.datetime.now()
-            if (now - start).seconds > timeout:
-                os.kill(result.pid, signal.SIGKILL)
-                os.waitpid(-1, os.WNOHANG)
-                #subprocess.call(['killall','run_network'])
-                subprocess.call(['killall','bngdev'])
-                return 5
+        finished = waitWithTimeout(result, timeout)
+        d.close()
+        if not finished:
+            return 5
         
-        d.close()                
-    return result.poll()
+    return result.returncode
     
+#error causes found in translation logs, and the errorLog entry they count to
+errorConditions = [('delay','delay'),('pseudo','pseudo'),('natural reactions','rules'),
+                   ('Malformed','malformed'),('dependency cycle','dependency'),
+                   ('non integer stoicheometries','noninteger')]
+#one bit per cause, in errorConditions order
+conditionBits = dict((x[0], 1 << idx) for idx, x in enumerate(errorConditions))
+errorPattern = re.compile('|'.join(['ERROR'] + [re.escape(x[0]) for x in errorConditions]))
+
 def analyzeErrors(directory):
     errorLog = {'delay':0,'noninteger':0,'pseudo':0,'dependency':0
     ,'rules':0,'others':0,'malformed':0}
-    onlyfiles = [ f for f in listdir('./' + directory) if isfile(join('./' + directory, f)) ]
+    onlyfiles = listFiles(directory)
     
-    logFiles = [x[0:-4] for x in onlyfiles if 'log' in x]
+    logFiles = [x[:-4] for x in onlyfiles if x.endswith('.log')]
     errorFiles = 0
     #dont skip the files that only have warnings    
     for log in logFiles:    
-        with open('./' + directory + '/' + log +'.log','r') as f:
-            k = f.readlines()
-            logText = ','.join(k)
-            conditions = ['delay','pseudo','natural reactions','Malformed','dependency cycle','non integer stoicheometries']
-            if 'ERROR' in logText:
-                errorFiles +=1
-                if 'delay' in logText and all([x not in logText for x in conditions if 'delay' != x]):
-                    errorLog['delay'] += 1
-
-                elif 'pseudo' in logText and all([x not in logText for x in conditions if 'pseudo' != x]):
-                    errorLog['pseudo'] += 1
-                elif 'natural reactions' in logText and all([x not in logText for x in conditions if 'natural reactions' != x]):
-                    errorLog['rules'] += 1
-                elif 'Malformed' in logText and all([x not in logText for x in conditions if 'Malformed' != x]):
-                    errorLog['malformed'] += 1
-                elif 'dependency cycle' in logText and all([x not in logText for x in conditions if 'dependency cycle' != x]):
-                    errorLog['dependency'] += 1
-                elif 'non integer stoicheometries' in logText and all([x not in logText for x in conditions if 'non integer stoicheometries' != x]):
-                    errorLog['noninteger'] += 1
-
-                else:
-                    errorLog['others'] +=1
+        hasError = False
+        mask = 0
+        with open(join(directory, log + '.log'),'rb') as f:
+            for line in f:
+                for match in errorPattern.findall(line):
+                    if match == 'ERROR':
+                        hasError = True
+                    else:
+                        mask |= conditionBits[match]
+        if hasError:
+            errorFiles +=1
+            #only classify logs that show a single known cause, i.e. a
+            #mask with exactly one bit set
+            if mask and mask & (mask - 1) == 0:
+                errorLog[errorConditions[mask.bit_length() - 1][1]] += 1
+            else:
+                errorLog['others'] +=1
     
     print errorLog,errorFiles
     
 def createValidFileBatch(directory):
     import zipfile
     
-    onlyfiles = [ f for f in listdir('./' + directory) if isfile(join('./' + directory, f)) ]
-    logFiles = [x[0:-4] for x in onlyfiles if x.endswith('log')]
-    errorFiles = []
+    onlyfiles = listFiles(directory)
+    logFiles = [x[:-4] for x in onlyfiles if x.endswith('.log')]
+    errorFiles = set()
     for x in logFiles:    
-        with open('./' + directory + '/' + x +'.log','r') as f:
-            k = f.readlines()
-            if 'ERROR' in ','.join(k):
-                errorFiles.append(x)
-    bnglFiles = [x for x in onlyfiles if x.endswith('bngl')]
+        with open(join(directory, x + '.log'),'rb') as f:
+            hasError = any(b'ERROR' in line for line in f)
+        if hasError:
+            errorFiles.add(x)
+    bnglFiles = [x for x in onlyfiles if x.endswith('.bngl')]
     validFiles = [x for x in bnglFiles if x not in errorFiles]
     
-    with zipfile.ZipFile('validComplex.zip','w') as myzip:
+    with zipfile.ZipFile('validComplex.zip','w',zipfile.ZIP_DEFLATED) as myzip:
         for bngl in validFiles:
-            myzip.write('./{0}/{1}'.format(directory,bngl),bngl)
+            myzip.write(join(directory, bngl),bngl)
     
+workerFiles = {}
+
+def initWorker():
+    """
+    Opens the files a pool worker sends bngdev output to, and keeps them
+    open for every model it runs. stderr goes to an anonymous temporary
+    file private to the worker, so parallel runs do not clobber each other
+    and nothing is left behind; stdout is never looked at.
+    """
+    workerFiles['stderr'] = tempfile.TemporaryFile('w+')
+    workerFiles['stdout'] = open(devnull, 'w')
+    #Ctrl-C is handled by the parent, which terminates the pool. Turn that
+    #SIGTERM into an exception so waitWithTimeout kills the running bngdev
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stopWorker)
+
+def stopWorker(signum, frame):
+    raise SystemExit(1)
+
+def startSession():
+    """
+    preexec_fn for bngdev runs in pool workers: its own process group, as
+    waitWithTimeout needs, and the default SIGINT handling that workers
+    turn off for themselves
+    """
+    os.setsid()
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
+def runOne(directory, bnglFile, timeout=30):
+    """
+    Runs bngdev on a single model from directory inside a worker set up by
+    initWorker. Returns the model name, whether it finished within
+    timeout, its return code and, for failed runs, its stderr lines.
+    """
+    outfile = workerFiles['stderr']
+    d = workerFiles['stdout']
+    outfile.seek(0)
+    outfile.truncate()
+    result = subprocess.Popen(['bngdev', join(directory, bnglFile)],stderr=outfile,stdout=d,preexec_fn=startSession)
+    finished = waitWithTimeout(result, timeout)
+    lines = []
+    if result.returncode > 0:
+        outfile.seek(0)
+        lines = outfile.readlines()
+    return bnglFile, finished, result.returncode, lines
+
+def runChecked(directory, bnglFile):
+    """
+    runOne for main's pool. Errors are handed back as the result because
+    python 2 only calls apply_async callbacks for calls that succeed.
+    """
+    try:
+        return True, runOne(directory, bnglFile)
+    except Exception as e:
+        return False, e
+
 def main():
     directory = 'raw'
-    onlyfiles = [ f for f in listdir('./' + directory) if isfile(join('./' + directory,f)) ]
+    onlyfiles = listFiles(directory)
     
-    logFiles = [x[0:-4] for x in onlyfiles if 'log' in x]
-    errorFiles = []
+    logFiles = [x[:-4] for x in onlyfiles if x.endswith('.log')]
+    errorFiles = set()
     #dont skip the files that only have warnings    
     for x in logFiles:    
-        with open('./' + directory + '/' + x +'.log','r') as f:
-            k = f.readlines()
-            if 'ERROR' in ','.join(k):
-                errorFiles.append(x)
-    bnglFiles = [x for x in onlyfiles if 'bngl' in x and 'log' not in x]
+        with open(join(directory, x + '.log'),'rb') as f:
+            hasError = any(b'ERROR' in line for line in f)
+        if hasError:
+            errorFiles.add(x)
+    bnglFiles = [x for x in onlyfiles if x.endswith('.bngl')]
     validFiles = [x for x in bnglFiles if x not in errorFiles]
     print 'Thrown out: {0}'.format(len(bnglFiles)-len(validFiles))
     skip = [] #['334','225','332','105','293','333','337','18','409']
+    runFiles = [x for x in sorted(validFiles) if len([y for y in skip if y in x]) == 0]
     counter = 0
+    #error log entries are written out in batches of this size
+    batch = 8
+    buf = []
     with open('executionTestErrors' + '.log', 'w') as f:
         subprocess.call(['rm','./*net'])
-        for idx,bnglFile in enumerate(sorted(validFiles)):
-            #if '100.' not in bnglFile:
-            #    continue
-            print bnglFile,
-            timeout = 30
-            if len([x for x in skip if x in bnglFile]) > 0: 
-                continue
-            with open('temp.tmp', "w") as outfile:
-                d = open('dummy.tmp','w')
-                start = datetime.datetime.now()
-                result = subprocess.Popen(['bngdev', './' + directory+ '/{0}'.format(bnglFile)],stderr=outfile,stdout=d)
-                while result.poll() is None:
-                    time.sleep(0.1)
-                    now = datetime.datetime.now()
-                    if (now - start).seconds > timeout:
-                        os.kill(result.pid, signal.SIGKILL)
-                        os.waitpid(-1, os.WNOHANG)
-                        subprocess.call(['killall','run_network'])
-                        print 'breaker',
-                        counter -=1
-                        break
-                
-                d.close()
-            if  result.poll() > 0:
-                
-                with open('temp.tmp','r') as outfile:
-                    lines = outfile.readlines()
-                tag = ''
-                if 'cvode' in ','.join(lines):
-                    print '///',bnglFile
-                    tag = 'cvode'
-                elif 'ABORT: Reaction rule list could not be read because of errors' in ','.join(lines):
-                    print '\\\\\\',bnglFile
-                #elif 'Incorrect number of arguments' in ','.join(lines):
-                #    print '[[]]',bnglFile
+        #every bngdev run is independent, so spread them over all cores and
+        #handle them in completion order so slow models don't hold up the rest
+        pool = multiprocessing.Pool(initializer=initWorker)
+        #each finished model is queued in done and announced with one byte
+        #on a pipe. A plain read on it sleeps until then, and unlike a
+        #timed wait on the pool it doesn't wake up early and still lets
+        #KeyboardInterrupt through
+        done = []
+        readEnd, writeEnd = os.pipe()
+        def collect(result):
+            done.append(result)
+            os.write(writeEnd, b'.')
+        try:
+            for bnglFile in runFiles:
+                pool.apply_async(runChecked, (directory, bnglFile), callback=collect)
+            for _ in runFiles:
+                os.read(readEnd, 1)
+                success, result = done.pop(0)
+                if not success:
+                    raise result
+                bnglFile, finished, returncode, lines = result
+                print bnglFile,
+                if not finished:
+                    print 'breaker',
+                    counter -=1
+                if  returncode > 0:
+                    tag = ''
+                    errors = set(stderrPattern.findall(''.join(lines)))
+                    if 'cvode' in errors:
+                        print '///',bnglFile
+                        tag = 'cvode'
+                    elif abortMessage in errors:
+                        print '\\\\\\',bnglFile
+                    #elif 'Incorrect number of arguments' in ','.join(lines):
+                    #    print '[[]]',bnglFile
+                    else:
+                        print '---',bnglFile
+                        tag = lines
+                        buf.append('%s %s\n' % (bnglFile,tag))
+                        if len(buf) >= batch:
+                            f.writelines(buf)
+                            f.flush()
+                            buf = []
                 else:
-                    print '---',bnglFile
-                    tag = lines
-                    f.write('%s %s\n' % (bnglFile,tag))
-                f.flush()
-            else:
-                counter += 1
-                print '+++',bnglFile
+                    counter += 1
+                    print '+++',bnglFile
+        except BaseException:
+            #don't wait for the queued models, and take the running bngdevs
+            #down with their workers
+            pool.terminate()
+            raise
+        else:
+            pool.close()
+        finally:
+            pool.join()
+            os.close(readEnd)
+            os.close(writeEnd)
+            f.writelines(buf)
     print counter
         
 
@@ -18,6 +18,14 @@ import os
 from subprocess import call
 import sys
 import fnmatch
+try:
+    from os import scandir
+except ImportError:
+    #Python 2 only has it as a backport
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 # import progressbar
 
 #sys.path.insert(0, '../utils/')
@@ -147,6 +155,16 @@ def logMess(logType,logMessage):
 
 
 
+def listFiles(directory):
+    """
+    Returns the names of the regular files in directory. scandir gets the
+    file type from the directory listing itself instead of one stat per
+    entry.
+    """
+    if scandir is not None:
+        return [e.name for e in scandir(directory) if e.is_file()]
+    return [f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))]
+
 def testBNGFailure(fileName):
     with open(os.devnull,"w") as f:
         result = call(['bngdev',fileName],stdout=f)
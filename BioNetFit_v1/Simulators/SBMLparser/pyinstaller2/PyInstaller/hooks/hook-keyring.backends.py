@@ -11,6 +11,16 @@
 Testing with keyring 3.7 on MacOS.
 """
 
+from PyInstaller.compat import is_darwin, is_win
 from PyInstaller.hooks.hookutils import collect_submodules
 
-hiddenimports = collect_submodules('keyring.backends')
+# Backends that can only ever load on another platform. Skipping them
+# saves analysing them and bundling them for nothing.
+_foreign = []
+if not is_darwin:
+    _foreign += ['keyring.backends.OS_X']
+if not is_win:
+    _foreign += ['keyring.backends.Windows', 'keyring.backends._win_crypto']
+
+hiddenimports = [mod for mod in collect_submodules('keyring.backends')
+                 if mod not in _foreign]
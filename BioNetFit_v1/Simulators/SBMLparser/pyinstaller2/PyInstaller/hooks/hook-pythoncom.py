@@ -13,20 +13,30 @@ pywin32 module supports frozen mode. In frozen mode it is looking
 in sys.path for file pythoncomXX.dll. Include the pythoncomXX.dll
 as a data file. The path to this dll is contained in __file__
 attribute.
+
+pythoncom.py is only a loader: importing it replaces the module with
+the dll, and only then does __file__ point at pythoncomXX.dll. Looking
+the module up without importing it (imp.find_module, importlib specs)
+would return the loader instead, so the import is kept. It runs in a
+separate interpreter and only on Windows, the only platform pywin32
+exists on.
 """
 
 import os.path
+from PyInstaller.compat import is_win
 from PyInstaller.hooks.hookutils import get_module_file_attribute
 
-_pth = get_module_file_attribute('pythoncom')
-
 # Binaries that should be included with the module 'pythoncom'.
 # List mod.pyinstaller_binaries gets extended.
-binaries = [
-    (
-        # Relative path in the ./dist/app_name/ directory.
-        os.path.basename(_pth),
-        # Absolute path on hard disk.
-        _pth,
+binaries = []
+
+if is_win:
+    _pth = get_module_file_attribute('pythoncom')
+    binaries.append(
+        (
+            # Relative path in the ./dist/app_name/ directory.
+            os.path.basename(_pth),
+            # Absolute path on hard disk.
+            _pth,
+        )
     )
-]